@@ -3,6 +3,7 @@ from TicketLib import Ticket
 from typing import Optional, List
 from ecdsa import SigningKey, VerifyingKey
 from datetime import datetime
+from Config import DEFAULT_TZ
 
 """
 チケットの中身を確認する
@@ -48,6 +49,11 @@ class TicketResult:
         result = TicketResult(state=TicketState.NoGoodOnVerification)
         return result
 
+    @classmethod
+    def is_ng_on_condition(cls, message: str=None):
+        result = TicketResult(state=TicketState.NoGoodOnCondition)
+        return result
+
 
 class CheckResult:
     """
@@ -110,6 +116,17 @@ class CheckDefinitionMaterials:
 
         return _func
 
+    @classmethod
+    def check_valid_date_now__(cls):
+        """
+        チェックのたびに現在時刻で有効期間を確認する
+        :return:
+        """
+        def _func(ticket: Ticket) -> CheckResult:
+            return cls.check_valid_date__(datetime.now(tz=DEFAULT_TZ))(ticket)
+
+        return _func
+
     @staticmethod
     def issued_specific_date__(
           date_to: Optional[datetime],
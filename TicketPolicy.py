@@ -0,0 +1,390 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from ecdsa import VerifyingKey
+from TicketLib import Ticket
+from Config import DEFAULT_TZ
+from TicketChecker import TicketChecker, TicketResult, TicketState, CheckDefinition, CheckDefinitionMaterials
+
+"""
+イベント・チケット種別ごとのチェックポリシー
+"""
+
+logger = logging.getLogger(__name__)
+
+WILDCARD = None
+
+PolicyKey = Tuple[Optional[int], Optional[int], Optional[int]]
+
+
+class PolicyStats:
+    """
+    ポリシーごとの利用統計
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self.hits += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    @property
+    def latency_average(self) -> float:
+        if self.hits == 0:
+            return 0.0
+
+        return self.latency_total / self.hits
+
+
+class CheckPolicy:
+    """
+    (event_id, ticket_type, user_type)に対応するチェック定義
+    """
+
+    def __init__(self, name: str, check_definition: CheckDefinition,
+                 event_id: Optional[int] = WILDCARD,
+                 ticket_type: Optional[int] = WILDCARD,
+                 user_type: Optional[int] = WILDCARD):
+        self.name = name
+        self.check_definition = check_definition
+        self.key: PolicyKey = (event_id, ticket_type, user_type)
+
+
+class PolicyIndex:
+    """
+    ポリシーの索引(作成後は変更しない)
+    """
+
+    def __init__(self, policies: List[CheckPolicy]):
+        self.policies: Dict[PolicyKey, CheckPolicy] = {}
+        names = set()
+        for policy in policies:
+            if policy.key in self.policies:
+                raise ValueError("Duplicated Policy: {0}".format(policy.key))
+            if policy.name in names:
+                raise ValueError("Duplicated Policy Name: {0}".format(policy.name))
+            self.policies[policy.key] = policy
+            names.add(policy.name)
+
+    def resolve(self, event_id: int, ticket_type: int, user_type: int) -> Optional[CheckPolicy]:
+        """
+        具体的なキーからポリシーを引く(最大8回の辞書参照)
+        :param event_id:
+        :param ticket_type:
+        :param user_type:
+        :return:
+        """
+        for candidate in self._fallbacks(event_id, ticket_type, user_type):
+            policy = self.policies.get(candidate)
+            if policy is not None:
+                return policy
+
+        return None
+
+    @staticmethod
+    def _fallbacks(event_id: int, ticket_type: int, user_type: int):
+        """
+        event_id > ticket_type > user_type の順に具体的なものを優先
+        """
+        for e in (event_id, WILDCARD):
+            for t in (ticket_type, WILDCARD):
+                for u in (user_type, WILDCARD):
+                    yield (e, t, u)
+
+
+class PolicyConfigLoader:
+    """
+    設定ファイル(JSON)からポリシーを作成する
+
+    {"policies": [{"name": "...", "event_id": 1, "ticket_type": null, "user_type": null,
+                   "checks": [{"material": "check_valid_date_now__"},
+                              {"material": "issued_specific_date__", "args": {"date_to": "2020-11-01T00:00:00+09:00"}}]}]}
+    """
+    materials = CheckDefinitionMaterials
+
+    @classmethod
+    def load(cls, path: str) -> List[CheckPolicy]:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+
+        if not isinstance(config, dict) or not isinstance(config.get("policies"), list):
+            raise ValueError("Invalid Config: policies must be a list")
+
+        return [cls._build_policy(entry) for entry in config["policies"]]
+
+    @classmethod
+    def _build_policy(cls, entry: Any) -> CheckPolicy:
+        if not isinstance(entry, dict):
+            raise ValueError("Invalid Policy: {0!r}".format(entry))
+        if not isinstance(entry.get("name"), str):
+            raise ValueError("Invalid Policy Name: {0!r}".format(entry.get("name")))
+
+        checks = entry.get("checks", [])
+        if not isinstance(checks, list):
+            raise ValueError("Invalid Checks: {0!r}".format(checks))
+
+        check_funcs = []
+        for check in checks:
+            if not isinstance(check, dict):
+                raise ValueError("Invalid Check: {0!r}".format(check))
+
+            name = check.get("material")
+            material = None
+            if isinstance(name, str) and not name.startswith("_") and name.endswith("__"):
+                material = getattr(cls.materials, name, None)
+            if material is None:
+                raise ValueError("Unknown Check Material: {0!r}".format(name))
+
+            args = check.get("args", {})
+            if not isinstance(args, dict):
+                raise ValueError("Invalid Check Args: {0!r}".format(args))
+
+            args = {key: cls._convert_arg(key, value) for key, value in args.items()}
+            check_funcs.append(material(**args))
+
+        return CheckPolicy(
+            name=entry["name"],
+            check_definition=CheckDefinition(check_funcs),
+            event_id=cls._key_value(entry, "event_id"),
+            ticket_type=cls._key_value(entry, "ticket_type"),
+            user_type=cls._key_value(entry, "user_type"),
+        )
+
+    @staticmethod
+    def _key_value(entry: Dict[str, Any], key: str) -> Optional[int]:
+        value = entry.get(key, WILDCARD)
+        if value is not WILDCARD and (not isinstance(value, int) or isinstance(value, bool)):
+            raise ValueError("Invalid {0}: {1!r}".format(key, value))
+
+        return value
+
+    @staticmethod
+    def _convert_arg(key: str, value: Any) -> Any:
+        """
+        date_から始まる引数はISO形式の日時として読む。タイムゾーンがなければDEFAULT_TZとみなす
+        """
+        if key.startswith("date_") and isinstance(value, str):
+            date_value = datetime.fromisoformat(value)
+            if date_value.tzinfo is None:
+                date_value = date_value.replace(tzinfo=DEFAULT_TZ)
+            return date_value
+
+        return value
+
+
+class CheckPolicyRegistry:
+    """
+    チェックポリシーの振り分け
+    """
+
+    def __init__(self, policies: Optional[List[CheckPolicy]] = None, config_path: Optional[str] = None):
+        self.config_path = config_path
+        self.stats: Dict[str, PolicyStats] = {}
+        self._stats_keys: Dict[str, PolicyKey] = {}
+        self._config_signature: Optional[Tuple[int, int]] = None
+        self._reload_lock = threading.Lock()
+        self._index = PolicyIndex([])
+
+        if policies is not None:
+            self.replace(policies)
+        elif config_path is not None:
+            self.reload_if_changed()
+
+    def replace(self, policies: List[CheckPolicy]):
+        """
+        索引を作り直して差し替える。処理中のチェックは古い定義のまま完了する
+        :param policies:
+        :return:
+        """
+        index = PolicyIndex(policies)
+        for policy in policies:
+            # 同じ名前でも対象キーが変わった場合は統計をやり直す
+            if self._stats_keys.get(policy.name) != policy.key:
+                self.stats[policy.name] = PolicyStats()
+                self._stats_keys[policy.name] = policy.key
+
+        self._index = index
+
+    def reload_if_changed(self) -> bool:
+        """
+        設定ファイルが更新されていれば読み直す
+        読み込みに失敗した場合は現在の索引を維持し、ファイルが再び更新されるまで再試行しない
+        :return: 読み直した場合True
+        """
+        if self.config_path is None:
+            return False
+
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return False
+
+        config_signature = (stat.st_mtime_ns, stat.st_size)
+        if config_signature == self._config_signature:
+            return False
+
+        with self._reload_lock:
+            if config_signature == self._config_signature:
+                return False
+
+            # 失敗した場合も記録し、同じファイルを毎回読み直さない
+            self._config_signature = config_signature
+            try:
+                self.replace(PolicyConfigLoader.load(self.config_path))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Failed to load check policies from %s: %r", self.config_path, e)
+                return False
+
+        return True
+
+    def resolve(self, ticket: Ticket) -> Optional[CheckPolicy]:
+        return self._index.resolve(
+            ticket.data["event_id"], ticket.data["ticket_type"], ticket.data["user_type"]
+        )
+
+    def check(self, ticket: Ticket, verifiers: List[VerifyingKey]) -> TicketResult:
+        """
+        チケットに対応するポリシーでチェックする
+        :param ticket:
+        :param verifiers:
+        :return:
+        """
+        policy = self.resolve(ticket)
+        if policy is None:
+            return TicketResult.is_ng_on_condition("チェックポリシーがありません")
+
+        time_start = time.perf_counter()
+        result = TicketChecker.check(ticket, verifiers=verifiers, check_definition=policy.check_definition)
+        self.stats[policy.name].record(time.perf_counter() - time_start)
+
+        return result
+
+
+if __name__ == "__main__":
+    import hashlib
+    import tempfile
+    from datetime import timedelta
+    from ecdsa import SigningKey, NIST256p
+    sk = SigningKey.generate(curve=NIST256p, hashfunc=hashlib.sha256)
+    vk = sk.get_verifying_key()
+
+    def _make_ticket(event_id: int, ticket_type: int, user_type: int, **kwargs) -> Ticket:
+        ticket = Ticket(event_id, ticket_type=ticket_type, user_type=user_type, **kwargs)
+        ticket.sign(sk)
+        return Ticket.import_from_binary(ticket.convert_with_signature())
+
+    config_mtime_ns = [time.time_ns()]
+
+    def _write_raw(path: str, text: str):
+        # 同じ時刻の刻みで書き込んでも変更を検知できるよう更新時刻をずらす
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        config_mtime_ns[0] += 1000000
+        os.utime(path, ns=(config_mtime_ns[0], config_mtime_ns[0]))
+
+    def _write_config(path: str, policies: Any):
+        _write_raw(path, json.dumps({"policies": policies}))
+
+    # 優先順位とワイルドカード
+    empty = CheckDefinition([])
+    registry = CheckPolicyRegistry([
+        CheckPolicy("exact", empty, 1, 2, 3),
+        CheckPolicy("event_type", empty, 1, 2, WILDCARD),
+        CheckPolicy("event_user", empty, 1, WILDCARD, 3),
+        CheckPolicy("any_user", empty, WILDCARD, WILDCARD, 3),
+        CheckPolicy("default", empty),
+    ])
+    assert registry.resolve(_make_ticket(1, 2, 3)).name == "exact"
+    assert registry.resolve(_make_ticket(1, 2, 4)).name == "event_type"
+    assert registry.resolve(_make_ticket(1, 5, 3)).name == "event_user"
+    assert registry.resolve(_make_ticket(9, 5, 3)).name == "any_user"
+    assert registry.resolve(_make_ticket(9, 5, 4)).name == "default"
+
+    for duplicated in ([CheckPolicy("a", empty, 1), CheckPolicy("b", empty, 1)],
+                       [CheckPolicy("a", empty, 1), CheckPolicy("a", empty, 2)]):
+        try:
+            PolicyIndex(duplicated)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError([policy.name for policy in duplicated])
+
+    # 統計
+    assert registry.check(_make_ticket(1, 2, 3), verifiers=[vk]).state.is_passed()
+    assert registry.check(_make_ticket(1, 2, 3), verifiers=[vk]).state.is_passed()
+    assert registry.stats["exact"].hits == 2
+    assert registry.stats["exact"].latency_total > 0
+    assert registry.stats["default"].hits == 0
+
+    # 設定ファイルからの読み込みと差し替え
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_path = os.path.join(tmpdir, "policies.json")
+        _write_config(config_path, [
+            {"name": "event1", "event_id": 1, "checks": [{"material": "check_valid_date_now__"}]},
+        ])
+        registry = CheckPolicyRegistry(config_path=config_path)
+        short_lived = _make_ticket(1, 0, 0, valid_until=datetime.now(tz=DEFAULT_TZ) + timedelta(seconds=3))
+        assert registry.check(short_lived, verifiers=[vk]).state.is_passed()
+        assert registry.check(_make_ticket(2, 0, 0), verifiers=[vk]).state is TicketState.NoGoodOnCondition
+        assert registry.reload_if_changed() is False
+
+        old_index = registry._index
+        _write_config(config_path, [
+            {"name": "event1", "event_id": 1},
+            {"name": "event2", "event_id": 2},
+        ])
+        assert registry.reload_if_changed() is True
+        assert registry._index is not old_index
+        assert registry.resolve(_make_ticket(2, 0, 0)).name == "event2"
+        assert registry.stats["event1"].hits == 1
+
+        # 壊れた設定・危険な材料・ファイル欠損では索引を維持する
+        current_index = registry._index
+        _write_raw(config_path, '{"policies": [')
+        assert registry.reload_if_changed() is False
+        failed_signature = registry._config_signature
+        assert registry.reload_if_changed() is False
+        assert registry._config_signature == failed_signature
+
+        for broken in ([1],
+                       {"a": 1},
+                       [{"name": "x", "checks": [{"material": "__init_subclass__"}]}],
+                       [{"name": "x", "checks": [{"material": 5}]}],
+                       [{"name": "x", "checks": [{"material": "check_valid_date_now__", "args": [1]}]}],
+                       [{"name": "x", "event_id": "1"}],
+                       [{"name": 1}]):
+            _write_config(config_path, broken)
+            assert registry.reload_if_changed() is False, broken
+        _write_raw(config_path, "[]")
+        assert registry.reload_if_changed() is False
+        os.remove(config_path)
+        assert registry.reload_if_changed() is False
+        assert registry._index is current_index
+
+        # タイムゾーンのない日時はDEFAULT_TZとみなす
+        _write_config(config_path, [
+            {"name": "issued", "checks": [{"material": "issued_specific_date__", "args": {"date_to": "2100-01-01"}}]},
+        ])
+        assert registry.reload_if_changed() is True
+        assert registry.check(_make_ticket(3, 0, 0, date_issued=datetime.now(tz=DEFAULT_TZ)), verifiers=[vk]).state.is_passed()
+
+        # 起動時に壊れた設定を渡しても例外にならない
+        _write_config(config_path, [1])
+        assert CheckPolicyRegistry(config_path=config_path).resolve(_make_ticket(1, 0, 0)) is None
+
+    # 現在時刻で判定する材料は構築後の時刻で判定される
+    time.sleep(4)
+    check_now = CheckDefinitionMaterials.check_valid_date_now__()
+    assert not check_now(short_lived).state
+    print("OK")
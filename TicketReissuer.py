@@ -0,0 +1,286 @@
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from ecdsa import SigningKey
+from ecdsa.util import sigencode_der
+from TicketLib import Ticket, AttributeBits
+
+"""
+チケットの一括変更・再発行
+"""
+
+
+PATCHABLE_FIELDS = frozenset([
+    "ticket_type",
+    "ticket_group_id",
+    "user_type",
+    "valid_times",
+    "options_byte",
+    "bypasses_byte",
+    "valid_since",
+    "valid_until",
+    "date_issued",
+    "description",
+])
+
+
+def _sign_payload(payload: bytes, signer: SigningKey) -> bytes:
+    """
+    署名を実施(プロセスプールに渡すためモジュール直下に置く)
+    ecdsaは純Pythonで署名中GILを保持するため、スレッドで並列化しても速くならない
+    :param payload:
+    :param signer:
+    :return:
+    """
+    return signer.sign_deterministic(payload, sigencode=sigencode_der)
+
+
+class TicketIdentity(NamedTuple):
+    """
+    置き換えられたチケットの識別情報(失効処理に渡す)
+    """
+    event_id: int
+    ticket_type: int
+    ticket_group_id: int
+    ticket_id: int
+    signature: Optional[bytes]
+
+    @classmethod
+    def from_ticket(cls, ticket: Ticket):
+        return TicketIdentity(
+            event_id=ticket.data["event_id"],
+            ticket_type=ticket.data["ticket_type"],
+            ticket_group_id=ticket.data["ticket_group_id"],
+            ticket_id=ticket.data["ticket_id"],
+            signature=ticket.signature,
+        )
+
+
+class TicketSelector:
+    """
+    変更対象のチケットを選択する
+    """
+
+    def __init__(self, data: List[Callable[[Ticket], bool]]):
+        self.data = data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __call__(self, ticket: Ticket) -> bool:
+        for condition in self.data:
+            if condition(ticket) is False:
+                return False
+
+        return True
+
+
+class TicketSelectorMaterials:
+    """
+    選択条件に用いる材料
+    """
+    @staticmethod
+    def event_id__(event_id: int):
+        def _func(ticket: Ticket) -> bool:
+            return ticket.data["event_id"] == event_id
+
+        return _func
+
+    @staticmethod
+    def ticket_type__(ticket_type: int):
+        def _func(ticket: Ticket) -> bool:
+            return ticket.data["ticket_type"] == ticket_type
+
+        return _func
+
+    @staticmethod
+    def group_range__(group_from: int, group_to: int):
+        """
+        ticket_group_idが範囲内(両端含む)かを確認する
+        :param group_from:
+        :param group_to:
+        :return:
+        """
+        def _func(ticket: Ticket) -> bool:
+            return group_from <= ticket.data["ticket_group_id"] <= group_to
+
+        return _func
+
+
+class ReissueReport:
+    """
+    一括再発行の結果
+    """
+
+    def __init__(self):
+        self.reissued: List[Ticket] = []
+        self.replaced: List[TicketIdentity] = []
+        self.skipped = 0
+        self.unchanged = 0
+        self.not_selected = 0
+        self.elapsed = 0.0
+
+    @property
+    def changed(self) -> int:
+        return len(self.reissued)
+
+    @property
+    def throughput(self) -> float:
+        """
+        1秒あたりの処理枚数
+        :return:
+        """
+        processed = self.changed + self.unchanged + self.skipped
+        if self.elapsed <= 0:
+            return 0.0
+
+        return processed / self.elapsed
+
+    def __str__(self) -> str:
+        return "changed: {0}, unchanged: {1}, skipped: {2}, {3:.1f} tickets/s".format(
+            self.changed, self.unchanged, self.skipped, self.throughput
+        )
+
+
+class TicketReissuer:
+    """
+    チケットの一括変更と再署名
+    """
+    _locked_attributes = AttributeBits.ChangeIsNotAllowed.value | AttributeBits.ChangedOnce.value
+
+    @classmethod
+    def reissue(cls,
+                tickets: List[Ticket],
+                selector: TicketSelector,
+                patch: Dict[str, Any],
+                signer: SigningKey,
+                max_workers: Optional[int] = None,
+                executor: Optional[Executor] = None,
+                ) -> ReissueReport:
+        """
+        選択したチケットに変更を適用し、内容が変わったものだけ再署名する
+        :param tickets:
+        :param selector:
+        :param patch: 変更するフィールドと値
+        :param signer:
+        :param max_workers:
+        :param executor: 署名に用いるExecutor(未指定時はProcessPoolExecutor)
+        :return:
+        """
+        cls._validate_patch(patch)
+
+        report = ReissueReport()
+        time_start = time.perf_counter()
+
+        targets = []
+        for ticket in tickets:
+            if not selector(ticket):
+                report.not_selected += 1
+                continue
+
+            if ticket.data["attributes_byte"] & cls._locked_attributes:
+                report.skipped += 1
+                continue
+
+            patched = cls._apply_patch(ticket, patch)
+            if patched.convert() == ticket.convert():
+                report.unchanged += 1
+                continue
+
+            patched.data["attributes_byte"] |= AttributeBits.ChangedOnce.value
+            targets.append((ticket, patched))
+
+        if len(targets) > 0:
+            payloads = [patched.convert() for _, patched in targets]
+
+            own_executor = executor is None
+            if own_executor:
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+
+            try:
+                chunksize = max(1, len(payloads) // ((max_workers or os.cpu_count() or 1) * 4))
+                signatures = list(executor.map(partial(_sign_payload, signer=signer), payloads, chunksize=chunksize))
+            finally:
+                if own_executor:
+                    executor.shutdown()
+
+            for (original, patched), payload, signature in zip(targets, payloads, signatures):
+                patched.data["signature"] = signature
+                patched.original_data = payload
+                patched.original_data_with_signature = patched.convert_with_signature()
+
+                report.reissued.append(patched)
+                report.replaced.append(TicketIdentity.from_ticket(original))
+
+        report.elapsed = time.perf_counter() - time_start
+        return report
+
+    @staticmethod
+    def _validate_patch(patch: Dict[str, Any]):
+        unknown_keys = set(patch) - PATCHABLE_FIELDS
+        if len(unknown_keys) > 0:
+            raise ValueError("Unknown Field: {0}".format(", ".join(sorted(unknown_keys))))
+
+        # 値の型・範囲はダミーのチケットを一度エンコードして確認する
+        try:
+            Ticket(0, **patch).convert()
+        except (AttributeError, OverflowError, TypeError, ValueError) as e:
+            raise ValueError("Invalid Patch Value: {0!r}".format(e))
+
+    @staticmethod
+    def _apply_patch(ticket: Ticket, patch: Dict[str, Any]) -> Ticket:
+        data = dict(ticket.data)
+        data.update(patch)
+        data["signature"] = None
+        return Ticket(**data)
+
+
+if __name__ == "__main__":
+    import hashlib
+    from datetime import datetime
+    from ecdsa import NIST256p
+    from Config import DEFAULT_TZ
+
+    sk = SigningKey.generate(curve=NIST256p, hashfunc=hashlib.sha256)
+    vk = sk.get_verifying_key()
+    valid_until = datetime(2030, 1, 1, tzinfo=DEFAULT_TZ)
+
+    tickets = [
+        Ticket(1, ticket_group_id=1, ticket_id=1),
+        Ticket(1, ticket_group_id=2, ticket_id=2, attributes_byte=AttributeBits.ChangeIsNotAllowed.value),
+        Ticket(1, ticket_group_id=2, ticket_id=3, attributes_byte=AttributeBits.ChangedOnce.value),
+        Ticket(1, ticket_group_id=3, ticket_id=4, valid_until=valid_until),
+        Ticket(1, ticket_group_id=9, ticket_id=5),
+        Ticket(2, ticket_group_id=1, ticket_id=6),
+    ]
+    for ticket in tickets:
+        ticket.sign(sk)
+
+    selector = TicketSelector([
+        TicketSelectorMaterials.event_id__(1),
+        TicketSelectorMaterials.group_range__(1, 3),
+    ])
+    report = TicketReissuer.reissue(tickets, selector, {"valid_until": valid_until}, signer=sk)
+    print(report)
+
+    assert report.not_selected == 2
+    assert report.skipped == 2
+    assert report.unchanged == 1
+    assert report.changed == 1
+    assert report.replaced == [TicketIdentity.from_ticket(tickets[0])]
+
+    reissued = Ticket.import_from_binary(report.reissued[0].convert_with_signature())
+    assert reissued.verify_original_data(verifier=vk)
+    assert reissued.valid_until == valid_until
+    assert reissued.data["attributes_byte"] & AttributeBits.ChangedOnce.value
+
+    for bad_patch in ({"symbol": "ZZZ"}, {"signature": b""}, {"attributes_byte": 0}, {"ticket_id": 7},
+                      {"valid_until": "2030-01-01"}, {"ticket_group_id": 70000}, {"description": None}):
+        try:
+            TicketReissuer.reissue(tickets, selector, bad_patch, signer=sk)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(bad_patch)